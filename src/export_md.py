@@ -1,9 +1,18 @@
 """
 Build and write the master index as Markdown to output/<book>_index.md.
 """
+import re
+from itertools import groupby
 from pathlib import Path
 from typing import Any
 
+# One index entry line: label, page display
+_ENTRY_LINE = "- **{}** — p. {}\n"
+
+# Filename-safe titles: keep alphanumerics, space, "_" and "-"; everything else becomes "_"
+_UNSAFE_ASCII = {i: "_" for i in range(128) if not (chr(i).isalnum() or chr(i) in " _-")}
+_UNSAFE_CHARS_RE = re.compile(r"[^\w \-]")
+
 
 def _display_label(term: str, subentry: str) -> str:
     """Format index label: 'Subentry term' when subentry present (title-cased), else term."""
@@ -29,42 +38,34 @@ def export_markdown(
     output_dir.mkdir(parents=True, exist_ok=True)
 
     if output_filename is None:
-        safe_title = "".join(c if c.isalnum() or c in " _-" else "_" for c in book_title).strip("_")
+        if book_title.isascii():
+            safe_title = book_title.translate(_UNSAFE_ASCII)
+        else:
+            safe_title = _UNSAFE_CHARS_RE.sub("_", book_title)
+        safe_title = safe_title.strip("_")
         output_filename = f"{safe_title}_index.md"
     out_path = output_dir / output_filename
 
-    lines: list[str] = []
-    lines.append(f"# {book_title}")
-    lines.append("")
-    lines.append("## Index (by order of appearance)")
-    lines.append("")
-
-    for section in grouped:
-        chapter_name = section.get("chapter_name", "Other")
-        entries = section.get("entries", [])
-        lines.append(f"### {chapter_name}")
-        lines.append("")
-        # Group entries by subheading (empty first, then first-appearance order)
-        subheading_order: list[str] = []
-        subheading_to_entries: dict[str, list[dict[str, Any]]] = {}
-        for e in entries:
-            subheading = e.get("subheading") or ""
-            if subheading not in subheading_to_entries:
-                subheading_order.append(subheading)
-                subheading_to_entries[subheading] = []
-            subheading_to_entries[subheading].append(e)
-        for subheading in subheading_order:
-            group_entries = subheading_to_entries[subheading]
-            if subheading:
-                lines.append(f"#### {subheading}")
-                lines.append("")
-            for e in group_entries:
-                term = e.get("term", "")
-                subentry = e.get("subentry", "")
-                page = e.get("page", "")
-                label = _display_label(term, subentry)
-                lines.append(f"- **{label}** — p. {page}")
-            lines.append("")
+    # Stream straight to the file; blank separators are written before each heading/group
+    with out_path.open("w", encoding="utf-8", buffering=1 << 16) as fh:
+        fh.write(f"# {book_title}\n")
+        fh.write("\n")
+        fh.write("## Index (by order of appearance)\n")
 
-    out_path.write_text("\n".join(lines), encoding="utf-8")
+        for section in grouped:
+            chapter_name = section.get("chapter_name", "Other")
+            entries = section.get("entries", [])
+            fh.write(f"\n### {chapter_name}\n")
+            # Group entries by subheading in first-appearance order (stable sort keeps entry order)
+            rank: dict[str, int] = {}
+            for e in entries:
+                rank.setdefault(e.get("subheading") or "", len(rank))
+            ordered = sorted(entries, key=lambda e: rank[e.get("subheading") or ""])
+            for subheading, group_entries in groupby(ordered, key=lambda e: e.get("subheading") or ""):
+                if subheading:
+                    fh.write(f"\n#### {subheading}\n")
+                fh.write("\n")
+                for e in group_entries:
+                    label = _display_label(e.get("term", ""), e.get("subentry", ""))
+                    fh.write(_ENTRY_LINE.format(label, e.get("page", "")))
     return out_path
@@ -2,13 +2,19 @@
 Extract TOC and index from an EPUB file.
 Uses toc.ncx (or nav), content.opf spine, and Index.xhtml parsing.
 """
+import os
 import re
+import sys
 import zipfile
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from pathlib import Path
 from xml.etree import ElementTree as ET
 from typing import Any
 
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 
 
 # Roman numeral to int for common front-matter pages (i, ii, iii, iv, v, vi, vii, viii, ix, x, xi, xii, xiii, xiv, ...)
@@ -19,50 +25,68 @@ ROMAN_TO_INT = {
 }
 
 
+# Strips everything but ASCII digits from a page label ("page_143a" -> "143")
+_DIGITS_ONLY_RE = re.compile(r"[^0-9]+")
+# Page anchor id or href fragment: page_143, page-xii, page295
+_PAGE_ID_RE = re.compile(r"page[_\-]?(\w+)", re.I)
+# Index entry paragraph classes (Index-1 main term, Index-2 subentry, Index-Alpha letter)
+_INDEX_CLASS_RE = re.compile(r"Index-(1|2|Alpha)", re.I)
+# Index paragraph classes that are never entries
+_INDEX_SKIP_CLASSES = frozenset({"Index-Note", "Index-Head"})
+# <a> as parsed from XHTML (namespaced) or via the HTML fallback (bare)
+_LINK_TAGS = frozenset({"a", "{http://www.w3.org/1999/xhtml}a"})
+# Index document by file name: "index" in the basename (not a directory), .xhtml/.html/.htm
+_INDEX_NAME_RE = re.compile(r"(?:^|/)[^/]*index[^/]*\.x?html?$", re.I)
+
+
 def _normalize_page(page_str: str) -> int:
     """Convert page string (numeric or roman) to int for sorting."""
-    page_str = page_str.strip().lower()
-    if page_str in ROMAN_TO_INT:
-        return ROMAN_TO_INT[page_str]
-    try:
-        return int(re.sub(r"[^\d]", "", page_str) or "0") or 0
-    except ValueError:
-        return 0
+    s = page_str.strip().lower()
+    value = ROMAN_TO_INT.get(s)
+    if value is not None:
+        return value
+    digits = _DIGITS_ONLY_RE.sub("", s)
+    return int(digits) if digits else 0
 
 
-def _get_opf_path(epub_path: str | Path) -> str:
+def _get_opf_path(zf: zipfile.ZipFile) -> str:
     """Read META-INF/container.xml to get path to content.opf."""
-    with zipfile.ZipFile(epub_path, "r") as z:
-        with z.open("META-INF/container.xml") as f:
-            tree = ET.parse(f)
-            root = tree.getroot()
-            # Default namespace
-            ns = {"c": "urn:oasis:names:tc:opendocument:xmlns:container"}
-            elem = root.find(".//c:rootfile[@media-type='application/oebps-package+xml']", ns)
-            if elem is not None and elem.get("full-path"):
-                return elem.get("full-path")
-            elem = root.find(".//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile")
-            if elem is not None and elem.get("full-path"):
-                return elem.get("full-path")
+    with zf.open("META-INF/container.xml") as f:
+        tree = ET.parse(f)
+        root = tree.getroot()
+        # Default namespace
+        ns = {"c": "urn:oasis:names:tc:opendocument:xmlns:container"}
+        elem = root.find(".//c:rootfile[@media-type='application/oebps-package+xml']", ns)
+        if elem is not None and elem.get("full-path"):
+            return elem.get("full-path")
+        elem = root.find(".//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile")
+        if elem is not None and elem.get("full-path"):
+            return elem.get("full-path")
     return "content.opf"
 
 
-def _parse_ncx(epub_path: str | Path, opf_path: str) -> list[dict[str, Any]]:
-    """Parse toc.ncx and return list of {title, href} for each navPoint (first occurrence per file)."""
-    opf_dir = str(Path(opf_path).parent)
-    ncx_path = None
-    with zipfile.ZipFile(epub_path, "r") as z:
-        for name in z.namelist():
-            if name.endswith("toc.ncx"):
-                ncx_path = name
-                break
-    if not ncx_path:
-        return []
+def _read_ncx(zf: zipfile.ZipFile, name_to_info: dict[str, zipfile.ZipInfo]) -> ET.Element | None:
+    """Parse toc.ncx once and return its root element, or None if the EPUB has no NCX."""
+    ncx_name = next((n for n in name_to_info if n.endswith("toc.ncx")), None)
+    if not ncx_name:
+        return None
+    with zf.open(name_to_info[ncx_name]) as f:
+        return ET.parse(f).getroot()
 
-    with zipfile.ZipFile(epub_path, "r") as z:
-        with z.open(ncx_path) as f:
-            tree = ET.parse(f)
-            root = tree.getroot()
+
+def _ncx_doc_title(root: ET.Element) -> str:
+    """Return the NCX <docTitle> text, or "" if missing."""
+    for t in root.iter():
+        if t.tag is not None and "docTitle" in t.tag and len(t) > 0:
+            for c in t:
+                if c.tag is not None and "text" in c.tag and (c.text or "").strip():
+                    return (c.text or "").strip()
+            break
+    return ""
+
+
+def _parse_ncx(root: ET.Element) -> list[dict[str, Any]]:
+    """Parse toc.ncx root and return list of {title, href} for each navPoint (first occurrence per file)."""
 
     def local(tag: str | None) -> str:
         if tag is None:
@@ -93,7 +117,7 @@ def _parse_ncx(epub_path: str | Path, opf_path: str) -> list[dict[str, Any]]:
         if not src:
             continue
         href_no_frag = src.split("#")[0]
-        base = Path(href_no_frag).name
+        base = href_no_frag.rsplit("/", 1)[-1]
         if base in seen_hrefs:
             continue
         seen_hrefs.add(base)
@@ -102,66 +126,85 @@ def _parse_ncx(epub_path: str | Path, opf_path: str) -> list[dict[str, Any]]:
     return toc
 
 
-def _parse_opf_manifest_spine(epub_path: str | Path, opf_path: str) -> tuple[dict[str, str], list[str]]:
-    """Return (id -> href map, ordered list of hrefs from spine)."""
-    with zipfile.ZipFile(epub_path, "r") as z:
-        with z.open(opf_path) as f:
-            tree = ET.parse(f)
-            root = tree.getroot()
+def _parse_opf_manifest_spine(
+    zf: zipfile.ZipFile, opf_path: str
+) -> tuple[dict[str, str], list[str], list[str]]:
+    """
+    Return (id -> href map, ordered list of hrefs from spine, hrefs the OPF marks as index).
+    Index hrefs come from manifest items with an "index" property and <guide> references of type "index".
+    """
+    with zf.open(opf_path) as f:
+        tree = ET.parse(f)
+        root = tree.getroot()
     ns = {"opf": "http://www.idpf.org/2007/opf"}
     manifest: dict[str, str] = {}
+    index_hrefs: list[str] = []
     for item in root.findall(".//{http://www.idpf.org/2007/opf}item"):
         item_id = item.get("id")
         href = item.get("href")
         if item_id and href:
             manifest[item_id] = href
+            if "index" in (item.get("properties") or "").split():
+                index_hrefs.append(href)
     spine_order: list[str] = []
     for itemref in root.findall(".//{http://www.idpf.org/2007/opf}itemref"):
         idref = itemref.get("idref")
         if idref and idref in manifest:
             spine_order.append(manifest[idref])
-    return manifest, spine_order
+    for ref in root.findall(".//{http://www.idpf.org/2007/opf}reference"):
+        href = (ref.get("href") or "").split("#")[0]
+        if href and (ref.get("type") or "").lower() == "index":
+            index_hrefs.append(href)
+    return manifest, spine_order, index_hrefs
+
+
+def _find_index_href(manifest: dict[str, str], index_hrefs: list[str]) -> str | None:
+    """Find href of the index document (marked as index in the OPF, else filename *index*.xhtml)."""
+    if index_hrefs:
+        return index_hrefs[0]
+    return next((href for href in manifest.values() if _INDEX_NAME_RE.search(href)), None)
 
 
-def _find_index_href(epub_path: str | Path, opf_path: str, manifest: dict[str, str]) -> str | None:
-    """Find href of the index document (epub:type=index or filename *Index*.xhtml)."""
-    opf_dir = str(Path(opf_path).parent)
-    for href in manifest.values():
-        if "index" in href.lower() and href.endswith((".xhtml", ".html")):
-            return href
-    return None
+def _element_text(el: Any) -> str:
+    """Stripped text pieces of an lxml element joined by single spaces."""
+    return " ".join(t.strip() for t in el.itertext() if t.strip())
 
 
-def _parse_chapter_subheadings(
-    epub_path: str | Path, opf_path: str, chapter_href: str
-) -> list[tuple[int, str]]:
+def _read_member(
+    zf: zipfile.ZipFile,
+    name_to_info: dict[str, zipfile.ZipInfo],
+    base_to_info: dict[str, zipfile.ZipInfo],
+    opf_path: str,
+    href: str,
+) -> bytes:
+    """Read a document (href relative to the OPF) from the archive, falling back to its basename; b"" if not found."""
+    opf_dir = Path(opf_path).parent
+    path = (opf_dir / href).as_posix().replace("//", "/")
+    info = name_to_info.get(path) or base_to_info.get(href.split("/")[-1])
+    if info is None:
+        return b""
+    return zf.read(info)
+
+
+def _parse_chapter_subheadings(raw: bytes) -> list[tuple[int, str]]:
     """
     Parse a chapter XHTML and return a sorted list of (page_int, subheading_str).
     Each tuple means "at this page, this subheading applies (until the next recorded page)."
     Subheadings are taken from <h2> and <h3>; page boundaries from elements with id="page_N".
+    Pure function of the chapter bytes, so chapters can be parsed in parallel.
     """
-    opf_dir = Path(opf_path).parent
-    chapter_path = (opf_dir / chapter_href).as_posix().replace("//", "/")
-    with zipfile.ZipFile(epub_path, "r") as z:
-        try:
-            raw = z.read(chapter_path)
-        except KeyError:
-            basename = chapter_href.split("/")[-1]
-            for name in z.namelist():
-                if name.endswith(basename):
-                    raw = z.read(name)
-                    break
-            else:
-                return []
-    soup = BeautifulSoup(raw, "lxml")
+    if not raw.strip():
+        return []
+    tree = lxml.html.fromstring(raw)
     current_subheading = ""
     last_recorded: str | None = None
     result: list[tuple[int, str]] = []
-    for tag in soup.find_all(True):
-        if tag.name in ("h2", "h3"):
-            current_subheading = (tag.get_text(separator=" ", strip=True) or "").strip()
+    # Only headings and id-bearing elements matter; let lxml select them in document order
+    for tag in tree.xpath("//*[self::h2 or self::h3 or @id]"):
+        if tag.tag in ("h2", "h3"):
+            current_subheading = _element_text(tag)
         elif tag.get("id"):
-            page_match = re.search(r"page[_\-]?(\w+)", tag.get("id", ""), re.I)
+            page_match = _PAGE_ID_RE.search(tag.get("id", ""))
             if page_match:
                 page_int = _normalize_page(page_match.group(1))
                 if last_recorded != current_subheading:
@@ -193,67 +236,69 @@ def _collapse_refs_to_ranges(
     return out
 
 
-def _parse_index_html(epub_path: str | Path, index_href: str, opf_path: str) -> list[dict[str, Any]]:
-    """Parse Index.xhtml and return list of {term, subentry, refs: [(file_basename, start_page, end_page), ...]} with end_page >= start_page."""
-    opf_dir = Path(opf_path).parent
-    # Resolve index path relative to opf
-    index_path = (opf_dir / index_href).as_posix().replace("//", "/")
-    with zipfile.ZipFile(epub_path, "r") as z:
-        try:
-            raw = z.read(index_path)
-        except KeyError:
-            # Try without leading path
-            for name in z.namelist():
-                if name.endswith(index_href.split("/")[-1]) and "index" in name.lower():
-                    raw = z.read(name)
-                    break
-            else:
-                return []
+def _text_before_first_link(p: Any) -> str:
+    """Term/subentry text: everything in <p> before its first <a> (page refs), so page numbers stay out."""
+    parts: list[str] = [p.text or ""]
+    for c in p:
+        if c.tag in _LINK_TAGS:
+            break
+        # Comments and processing instructions have a non-str tag; only their tail is text
+        if isinstance(c.tag, str):
+            parts.append(_element_text(c))
+        parts.append(c.tail or "")
+    return "".join(parts).strip().strip(",").strip()
+
 
-    soup = BeautifulSoup(raw, "lxml")
-    # Find all index entry paragraphs (Index-1, Index-2, Index-Alpha; exclude Index-Note, Index-Head)
+def _iter_index_paragraphs(raw: bytes, html: bool = False) -> Iterator[Any]:
+    """
+    Stream <p> elements of an index document as each one finishes parsing.
+    After the caller is done with a paragraph it is cleared, along with already-seen siblings,
+    so memory stays around one paragraph rather than the whole index tree.
+    """
+    for _, p in etree.iterparse(BytesIO(raw), events=("end",), tag="{*}p", html=html, huge_tree=True):
+        yield p
+        p.clear()
+        parent = p.getparent()
+        while p.getprevious() is not None:
+            del parent[0]
+
+
+def _parse_index_paragraphs(paragraphs: Iterator[Any]) -> list[dict[str, Any]]:
+    """Turn index <p> elements into {term, subentry, refs} entries (see _parse_index_html)."""
+    # Index entry paragraphs: Index-1, Index-2, Index-Alpha; exclude Index-Note, Index-Head
     entries: list[dict[str, Any]] = []
     current_main_term: str = ""
 
-    for p in soup.find_all("p", class_=re.compile(r"Index-(1|2|Alpha)", re.I)):
-        if not p.get("class"):
+    for p in paragraphs:
+        classes = p.get("class") or ""
+        if not _INDEX_CLASS_RE.search(classes):
             continue
-        classes = " ".join(p.get("class", []))
-        if "Index-Note" in classes or "Index-Head" in classes:
+        if not _INDEX_SKIP_CLASSES.isdisjoint(classes.split()):
             continue
 
         # Extract refs: <a href="...xhtml#page_N"> or #page_N
         refs: list[tuple[str, int]] = []
-        for a in p.find_all("a", href=True):
-            href = a.get("href", "")
+        for a in p.iter("{*}a"):
+            href = a.get("href")
+            if not href:
+                continue
             if "#page_" not in href and "#page" not in href.lower():
                 continue
             parts = href.split("#", 1)
             if len(parts) != 2:
                 continue
             path_part, frag = parts
-            file_basename = Path(path_part).name if path_part else ""
+            # Interned: thousands of refs share a few dozen chapter files, so later dict lookups hit by identity
+            file_basename = sys.intern(path_part.rsplit("/", 1)[-1]) if path_part else ""
             if not file_basename:
                 continue
             # Fragment: page_143 or page_xii or page_295
-            page_match = re.search(r"page[_\-]?(\w+)", frag, re.I)
+            page_match = _PAGE_ID_RE.search(frag)
             if page_match:
                 page_str = page_match.group(1)
                 refs.append((file_basename, _normalize_page(page_str)))
 
-        # Term and subentry: use text before first <a> (page refs) to avoid page numbers in term
-        def text_before_first_link(tag) -> str:
-            parts: list[str] = []
-            for c in tag.children:
-                if getattr(c, "name", None) == "a":
-                    break
-                if isinstance(c, str):
-                    parts.append(c)
-                elif hasattr(c, "get_text"):
-                    parts.append(c.get_text(separator=" ", strip=True))
-            return "".join(parts).strip().strip(",").strip()
-
-        raw_text = text_before_first_link(p)
+        raw_text = _text_before_first_link(p)
         # "see also" / "see" entries have no refs - skip or keep with empty refs (skip for mapping)
         if "Index-2" in classes or "index-2" in classes:
             subentry = raw_text
@@ -271,6 +316,25 @@ def _parse_index_html(epub_path: str | Path, index_href: str, opf_path: str) ->
     return entries
 
 
+def _parse_index_html(
+    zf: zipfile.ZipFile,
+    name_to_info: dict[str, zipfile.ZipInfo],
+    base_to_info: dict[str, zipfile.ZipInfo],
+    index_href: str,
+    opf_path: str,
+) -> list[dict[str, Any]]:
+    """Parse Index.xhtml and return list of {term, subentry, refs: [(file_basename, start_page, end_page), ...]} with end_page >= start_page."""
+    raw = _read_member(zf, name_to_info, base_to_info, opf_path, index_href)
+    if not raw.strip():
+        return []
+
+    try:
+        return _parse_index_paragraphs(_iter_index_paragraphs(raw))
+    except etree.XMLSyntaxError:
+        # Not well-formed XML (e.g. undeclared HTML entities like &nbsp;): reparse as HTML
+        return _parse_index_paragraphs(_iter_index_paragraphs(raw, html=True))
+
+
 def extract_epub(epub_path: str | Path) -> dict[str, Any]:
     """
     Extract TOC and index from an EPUB.
@@ -286,51 +350,55 @@ def extract_epub(epub_path: str | Path) -> dict[str, Any]:
     if not epub_path.exists():
         raise FileNotFoundError(f"EPUB not found: {epub_path}")
 
-    opf_path = _get_opf_path(epub_path)
-    manifest, spine_hrefs = _parse_opf_manifest_spine(epub_path, opf_path)
-    toc = _parse_ncx(epub_path, opf_path)
-    file_to_chapter: dict[str, str] = {e["file_basename"]: e["title"] for e in toc}
-
-    # Book title from OPF (dc:title) or NCX (docTitle)
-    book_title = ""
-    with zipfile.ZipFile(epub_path, "r") as z:
-        with z.open(opf_path) as f:
+    with zipfile.ZipFile(epub_path, "r") as zf:
+        # Archive members by full name and by basename (first wins) for O(1) lookups
+        infos = zf.infolist()
+        name_to_info = {zi.filename: zi for zi in infos}
+        base_to_info: dict[str, zipfile.ZipInfo] = {}
+        for zi in infos:
+            base_to_info.setdefault(zi.filename.rsplit("/", 1)[-1], zi)
+        opf_path = _get_opf_path(zf)
+        manifest, spine_hrefs, opf_index_hrefs = _parse_opf_manifest_spine(zf, opf_path)
+        ncx_root = _read_ncx(zf, name_to_info)
+        toc = _parse_ncx(ncx_root) if ncx_root is not None else []
+        file_to_chapter: dict[str, str] = {e["file_basename"]: e["title"] for e in toc}
+
+        # Book title from OPF (dc:title) or NCX (docTitle)
+        book_title = ""
+        with zf.open(opf_path) as f:
             tree = ET.parse(f)
             root = tree.getroot()
             for t in root.iter():
                 if t.tag is not None and "title" in t.tag.lower() and (t.text or "").strip():
                     book_title = (t.text or "").strip()
                     break
-    if not book_title and toc:
-        ncx_path = next((n for n in zipfile.ZipFile(epub_path, "r").namelist() if n.endswith("toc.ncx")), None)
-        if ncx_path:
-            with zipfile.ZipFile(epub_path, "r") as z:
-                with z.open(ncx_path) as f:
-                    ncx = ET.parse(f)
-                    for t in ncx.getroot().iter():
-                        if t.tag is not None and "docTitle" in t.tag and len(t) > 0:
-                            for c in t:
-                                if c.tag is not None and "text" in c.tag and (c.text or "").strip():
-                                    book_title = (c.text or "").strip()
-                                    break
-                            break
-    if not book_title:
-        book_title = epub_path.stem
-
-    index_href = _find_index_href(epub_path, opf_path, manifest)
-    index_entries: list[dict[str, Any]] = []
-    if index_href:
-        index_entries = _parse_index_html(epub_path, index_href, opf_path)
-
-    subheading_by_file_and_page: dict[str, list[tuple[int, str]]] = {}
-    for toc_entry in toc:
-        href = toc_entry.get("href", "")
-        file_basename = toc_entry.get("file_basename") or Path(href).name
-        if not href:
-            continue
-        subheading_by_file_and_page[file_basename] = _parse_chapter_subheadings(
-            epub_path, opf_path, href
-        )
+        if not book_title and toc and ncx_root is not None:
+            book_title = _ncx_doc_title(ncx_root)
+        if not book_title:
+            book_title = epub_path.stem
+
+        index_href = _find_index_href(manifest, opf_index_hrefs)
+        index_entries: list[dict[str, Any]] = []
+        if index_href:
+            index_entries = _parse_index_html(zf, name_to_info, base_to_info, index_href, opf_path)
+
+        # Zip reads stay serial (ZipFile is not thread-safe); parsing fans out below
+        chapters: list[tuple[str, bytes]] = []
+        for toc_entry in toc:
+            href = toc_entry.get("href", "")
+            file_basename = toc_entry.get("file_basename") or href.rsplit("/", 1)[-1]
+            if not href:
+                continue
+            raw = _read_member(zf, name_to_info, base_to_info, opf_path, href)
+            chapters.append((file_basename, raw))
+
+    # lxml releases the GIL while parsing, so threads overlap chapter parses
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        parsed = pool.map(_parse_chapter_subheadings, [raw for _, raw in chapters])
+        subheading_by_file_and_page: dict[str, list[tuple[int, str]]] = {
+            file_basename: subheadings
+            for (file_basename, _), subheadings in zip(chapters, parsed)
+        }
 
     return {
         "book_title": book_title,
@@ -38,8 +38,9 @@ def extract_pdf(
             return ""
         parts = []
         for i in range(start - 1, end):
-            page = doc[i]
-            parts.append(page.get_text("text"))
+            # Blocks are (x0, y0, x1, y1, text, block_no, block_type); keep non-empty text blocks (type 0)
+            blocks = doc[i].get_text("blocks")
+            parts.append("".join(b[4] for b in blocks if b[6] == 0 and b[4].strip()))
         return "\n".join(parts)
 
     toc_raw = extract_range(toc_start_page, toc_end_page)
@@ -2,30 +2,57 @@
 Map index refs to chapters and sort by order of appearance (first occurrence per term).
 Unified logic for EPUB (file -> chapter) and PDF (page -> chapter).
 """
+import sys
+from bisect import bisect_right
+from collections import defaultdict
 from typing import Any
 
+# Earliest ref of a (term, subentry): (chapter_order, start_page, chapter, subheading, page_display)
+FirstRef = tuple[int, int, str, str, str]
+
 
 def _page_display(start: int, end: int) -> str:
     """Format page as '120' or '120-125' for display."""
     return str(start) if start == end else f"{start}-{end}"
 
 
-def _subheading_for_ref(
-    file_basename: str,
-    page: int,
-    subheading_by_file_and_page: dict[str, list[tuple[int, str]]] | None,
-) -> str:
-    """Return the subheading for (file_basename, page) using the compressed list (last p <= page)."""
-    if not subheading_by_file_and_page:
-        return ""
-    lst = subheading_by_file_and_page.get(file_basename) or []
-    subheading = ""
-    for p, s in lst:
-        if p <= page:
-            subheading = s
-        else:
-            break
-    return subheading or ""
+def _build_subheading_index(
+    subheading_by_file_and_page: dict[str, list[tuple[int, str]]],
+) -> dict[str, tuple[list[int], list[str]]]:
+    """Split each file's sorted (page, subheading) list into parallel (pages, subheadings) lists."""
+    return {
+        file_basename: ([p for p, _ in lst], [s for _, s in lst])
+        for file_basename, lst in subheading_by_file_and_page.items()
+    }
+
+
+def _resolve_epub_first_refs(
+    winners: dict[tuple[str, str], tuple[int, int, str, int]],
+    file_to_chapter: dict[str, str],
+    subheading_index: dict[str, tuple[list[int], list[str]]],
+) -> dict[tuple[str, str], FirstRef]:
+    """
+    Turn winners = (term, subentry) -> (chapter_order, start, file_basename, end) into FirstRefs.
+    Refs are grouped by file and walked in page order, so each file's subheading list is scanned
+    once with a forward-only pointer (subheading = last one with p <= start).
+    """
+    by_file: dict[str, list[tuple[int, tuple[str, str]]]] = defaultdict(list)
+    for key, (_, start, file_basename, _) in winners.items():
+        by_file[file_basename].append((start, key))
+
+    best: dict[tuple[str, str], FirstRef] = {}
+    for file_basename, refs in by_file.items():
+        chapter = file_to_chapter.get(file_basename, "Other")
+        pages, subheadings = subheading_index.get(file_basename) or ([], [])
+        refs.sort()
+        j, subheading = 0, ""
+        for start, key in refs:
+            while j < len(pages) and pages[j] <= start:
+                subheading = subheadings[j] or ""
+                j += 1
+            order, _, _, end = winners[key]
+            best[key] = (order, start, chapter, subheading, _page_display(start, end))
+    return best
 
 
 def map_and_sort_epub(
@@ -40,21 +67,20 @@ def map_and_sort_epub(
     Sort by (chapter_order, start page). One entry per term (first appearance).
     Returns list of {chapter_name, entries: [{term, subentry, page, subheading?}, ...]} in chapter order.
     """
-    from pathlib import Path
-
-    # Build spine order: href -> order index (by basename)
-    href_to_basename = {h: Path(h).name for h in spine_hrefs}
+    # Build spine order: basename -> first spine position
     basename_to_order: dict[str, int] = {}
     for i, href in enumerate(spine_hrefs):
-        base = href_to_basename.get(href) or Path(href).name
+        base = href.rsplit("/", 1)[-1]
         if base not in basename_to_order:
             basename_to_order[base] = i
 
-    # Explode: (term, subentry, refs) -> list of (term, subentry, chapter, start, order, subheading, page_display)
-    rows: list[tuple[str, str, str, int, int, str, str]] = []
+    subheading_index = _build_subheading_index(subheading_by_file_and_page or {})
+
+    # Reduce refs to the earliest (chapter_order, start) per (term, subentry); ties keep the first seen.
+    # Chapter and subheading are resolved afterwards, only for the winning refs.
+    winners: dict[tuple[str, str], tuple[int, int, str, int]] = {}
     for item in index_entries:
-        term = (item.get("term") or "").strip()
-        subentry = (item.get("subentry") or "").strip()
+        key = ((item.get("term") or "").strip(), (item.get("subentry") or "").strip())
         refs = item.get("refs") or []
         for ref in refs:
             if len(ref) == 2:
@@ -64,15 +90,12 @@ def map_and_sort_epub(
                 file_basename, start, end = ref[0], ref[1], ref[2]
             if not file_basename:
                 continue
-            chapter = file_to_chapter.get(file_basename, "Other")
             order = basename_to_order.get(file_basename, 9999)
-            subheading = _subheading_for_ref(
-                file_basename, start, subheading_by_file_and_page
-            )
-            page_display = _page_display(start, end)
-            rows.append((term, subentry, chapter, start, order, subheading, page_display))
+            cur = winners.get(key)
+            if cur is None or (order, start) < (cur[0], cur[1]):
+                winners[key] = (order, start, file_basename, end)
 
-    return _first_appearance_by_chapter(rows)
+    return _first_appearance_by_chapter(_resolve_epub_first_refs(winners, file_to_chapter, subheading_index))
 
 
 def map_and_sort_pdf(
@@ -84,10 +107,22 @@ def map_and_sort_pdf(
     Sort by (chapter_order, start page). One entry per term (first appearance).
     Returns list of {chapter_name, entries: [{term, subentry, page}, ...]} in chapter order.
     """
-    rows: list[tuple[str, str, str, int, int, str, str]] = []
+    # TOC sorted by start page for bisect, split into parallel lists; the original position is the chapter order
+    toc_sorted = sorted(enumerate(toc), key=lambda t: t[1].get("start_page", 0))
+    starts = [ch.get("start_page", 0) for _, ch in toc_sorted]
+    ends = [ch.get("end_page", 0) for _, ch in toc_sorted]
+    orders = [order for order, _ in toc_sorted]
+    names = [sys.intern(ch.get("name", "Other")) for _, ch in toc_sorted]
+    n_toc = len(starts)
+
+    # Finger into the TOC: refs of one term are mostly in page order and near each other, so the slot
+    # found for the previous ref ([slot_lo, slot_hi) between consecutive starts) usually holds the next one
+    i, slot_lo, slot_hi = -1, 0, 0
+
+    # Reduce refs to the earliest (chapter_order, start) per (term, subentry); ties keep the first seen
+    best: dict[tuple[str, str], FirstRef] = {}
     for item in index_entries:
-        term = (item.get("term") or "").strip()
-        subentry = (item.get("subentry") or "").strip()
+        key = ((item.get("term") or "").strip(), (item.get("subentry") or "").strip())
         refs = item.get("refs") or []
         for ref in refs:
             if len(ref) == 2:
@@ -97,67 +132,47 @@ def map_and_sort_pdf(
                 _f, start, end = ref[0], ref[1], ref[2]
             chapter = "Other"
             order = 9999
-            for i, ch in enumerate(toc):
-                ch_start = ch.get("start_page", 0)
-                ch_end = ch.get("end_page", 0)
-                if ch_start <= start <= ch_end:
-                    chapter = ch.get("name", "Other")
-                    order = i
-                    break
-            page_display = _page_display(start, end)
-            rows.append((term, subentry, chapter, start, order, "", page_display))
+            if not slot_lo <= start < slot_hi:
+                i = bisect_right(starts, start) - 1
+                slot_lo = starts[i] if i >= 0 else float("-inf")
+                slot_hi = starts[i + 1] if i + 1 < n_toc else float("inf")
+            if i >= 0 and start <= ends[i]:
+                order = orders[i]
+                chapter = names[i]
+            cur = best.get(key)
+            if cur is None or (order, start) < (cur[0], cur[1]):
+                best[key] = (order, start, chapter, "", _page_display(start, end))
 
-    return _first_appearance_by_chapter(rows)
+    return _first_appearance_by_chapter(best)
 
 
 def _first_appearance_by_chapter(
-    rows: list[tuple[str, str, str, int, int, str, str]],
+    best: dict[tuple[str, str], FirstRef],
 ) -> list[dict[str, Any]]:
     """
-    rows = (term, subentry, chapter, start_page, chapter_order, subheading, page_display).
-    Sort by (chapter_order, start_page). Keep first occurrence per (term, subentry).
-    Group by chapter; within chapter sort by start_page. Entry page is display string ("120" or "120-125").
+    best = (term, subentry) -> (chapter_order, start_page, chapter, subheading, page_display) of its first appearance.
+    Sort by (chapter_order, start_page), then (term, subentry) for stability.
+    Group by chapter in that same order, so entries within a chapter are already by start_page.
+    Entry page is display string ("120" or "120-125").
     """
-    if not rows:
+    if not best:
         return []
 
-    # Sort by chapter_order then start_page, then (term, subentry) for stability
-    rows_sorted = sorted(rows, key=lambda r: (r[4], r[3], r[0], r[1]))
-
-    # First appearance per (term, subentry)
-    seen: set[tuple[str, str]] = set()
-    first_occurrences: list[tuple[str, str, str, int, str, str]] = []
-    for term, subentry, chapter, start_page, _, subheading, page_display in rows_sorted:
-        key = (term, subentry)
-        if key in seen:
-            continue
-        seen.add(key)
-        first_occurrences.append((term, subentry, chapter, start_page, subheading, page_display))
-
-    # Group by chapter (preserve order of first occurrence)
-    chapter_order: list[str] = []
-    chapter_entries: dict[str, list[dict[str, Any]]] = {}
-    for term, subentry, chapter, start_page, subheading, page_display in first_occurrences:
-        if chapter not in chapter_order:
-            chapter_order.append(chapter)
-        if chapter not in chapter_entries:
-            chapter_entries[chapter] = []
+    # Flat rows compare natively on (chapter_order, start_page, term, subentry); (term, subentry) is unique,
+    # so the trailing fields never decide the order and no Python key function is needed
+    first_occurrences = sorted([
+        (order, start, term, subentry, chapter, subheading, page_display)
+        for (term, subentry), (order, start, chapter, subheading, page_display) in best.items()
+    ])
+
+    # Group by chapter (dict keeps first-seen chapter order)
+    chapter_entries: dict[str, list[dict[str, Any]]] = defaultdict(list)
+    for _, _, term, subentry, chapter, subheading, page_display in first_occurrences:
         chapter_entries[chapter].append({
             "term": term,
             "subentry": subentry,
             "page": page_display,
             "subheading": subheading,
-            "_sort_page": start_page,
         })
 
-    # Sort entries within each chapter by start_page, then drop sort key
-    for ch in chapter_entries:
-        chapter_entries[ch].sort(key=lambda e: (e["_sort_page"], e["term"], e["subentry"]))
-        for e in chapter_entries[ch]:
-            del e["_sort_page"]
-
-    return [
-        {"chapter_name": ch, "entries": chapter_entries[ch]}
-        for ch in chapter_order
-        if ch in chapter_entries
-    ]
+    return [{"chapter_name": ch, "entries": entries} for ch, entries in chapter_entries.items()]
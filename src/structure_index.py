@@ -2,8 +2,18 @@
 Structure raw index text into JSON using an LLM (for PDF path).
 Also optional: structure TOC raw text into chapter name + page ranges.
 """
+import asyncio
+import contextlib
+import functools
+import hashlib
+import inspect
 import json
 import os
+import random
+import re
+import time
+from collections.abc import AsyncIterator, Callable
+from pathlib import Path
 from typing import Any
 
 from dotenv import load_dotenv
@@ -18,27 +28,246 @@ For "pages", preserve ranges from the index. Each element is an object with "sta
 Example: "120-125, 130" becomes "pages": [{"start": 120, "end": 125}, {"start": 130, "end": 130}].
 Roman numerals (ix, xi, xii) should be converted to integers (9, 11, 12).
 Skip "see also" and "see" cross-reference lines that have no page numbers.
+The text may be one part of a longer index. A [Context] section, if present, repeats the index lines just before it.
+Do not convert the [Context] lines; use them only to find the main term of subentries at the top of the text.
+Return a single JSON object {"entries": [...]} holding that list.
 Return only valid JSON, no markdown or explanation.
 
 Raw index text:
-
-{index_raw}
 """
 
 TOC_STRUCTURE_PROMPT = """You will receive raw text from a book's table of contents. Convert it into a JSON list of objects.
 Each object must have: "name" (chapter/section title), "start_page" (integer), "end_page" (integer).
 Infer end_page as the start_page of the next chapter minus 1, or use the last page of the book for the last chapter.
 Roman numerals (ix, xi, etc.) should be converted to integers.
+Return a single JSON object {"chapters": [...]} holding that list.
 Return only valid JSON, no markdown or explanation.
 
 Raw TOC text:
 
-{toc_raw}
 """
 
+# Response schemas (JSON Schema subset understood by both Gemini response_schema and OpenAI structured outputs).
+# The provider enforces them, so responses are plain JSON with every field present.
+_INDEX_ITEM_SCHEMA: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "term": {"type": "string"},
+        "subentry": {"type": "string"},
+        "pages": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"start": {"type": "integer"}, "end": {"type": "integer"}},
+                "required": ["start", "end"],
+            },
+        },
+    },
+    "required": ["term", "subentry", "pages"],
+}
+
+INDEX_SCHEMA: dict[str, Any] = {
+    "type": "object",
+    "properties": {"entries": {"type": "array", "items": _INDEX_ITEM_SCHEMA}},
+    "required": ["entries"],
+}
+
+TOC_SCHEMA: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "chapters": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "start_page": {"type": "integer"},
+                    "end_page": {"type": "integer"},
+                },
+                "required": ["name", "start_page", "end_page"],
+            },
+        },
+    },
+    "required": ["chapters"],
+}
+
+GEMINI_MODEL = "gemini-2.0-flash"
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Output token limit used per model (gemini-2.0-flash caps output at 8192 tokens)
+MAX_OUTPUT_TOKENS = {GEMINI_MODEL: 8192, OPENAI_MODEL: 16000}
+
+# Structured index JSON runs ~1 output token per input char (~3.8x the chars: keys and a {start, end} object
+# per page). Each request gets INDEX_OUTPUT_HEADROOM of the output budget's worth of index text, so dense
+# pages still fit; a response that hits the limit anyway is split and re-requested.
+INDEX_OUTPUT_TOKENS_PER_CHAR = 1.0
+INDEX_OUTPUT_HEADROOM = 0.4
+# Trailing lines of the preceding text sent as [Context] with each request after the first
+INDEX_CONTEXT_LINES = 8
+
+# Raw LLM responses, keyed by sha256(model | max_tokens | prompt); relative to the working directory
+LLM_CACHE_DIR = Path(".llm_cache")
+
+# Opt-in: submit index requests through the OpenAI Batch API (BOOK_INDEXED_BATCH=1) at ~50% token cost;
+# results can take minutes to hours, polled every OPENAI_BATCH_POLL_SECONDS.
+OPENAI_BATCH_POLL_SECONDS = 30
+# Batch jobs per _call_openai_batch: failed requests are resubmitted until this many jobs have run
+OPENAI_BATCH_MAX_ATTEMPTS = 3
+
+# Concurrent index requests (override with LLM_MAX_CONCURRENCY). Rate-limit (429), server (5xx) and
+# connection errors are retried up to LLM_MAX_RETRIES times with jittered exponential backoff.
+LLM_MAX_CONCURRENCY = 4
+LLM_MAX_RETRIES = 5
+LLM_RETRY_BASE_SECONDS = 1.0
+LLM_RETRY_MAX_SECONDS = 30.0
+# Matched by class name (including base classes) so neither SDK has to be importable
+_RETRYABLE_ERROR_NAMES = frozenset({
+    "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError",
+    "ServerError", "ConnectError", "ConnectTimeout", "ReadTimeout", "RemoteProtocolError",
+})
+
+# Markdown code fence lines (```json ... ```) stripped before JSON extraction
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*$", re.M | re.I)
+_JSON_DECODER = json.JSONDecoder()
+
+# Index text pre-cleaning: runs of spaces/tabs, trailing whitespace, and 3+ consecutive newlines
+_INLINE_SPACE_RE = re.compile(r"[ \t]+")
+_TRAILING_SPACE_RE = re.compile(r" +$", re.M)
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def _active_model() -> str:
+    """Return the model name _call_llm would use with the current environment."""
+    if os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"):
+        return GEMINI_MODEL
+    if os.environ.get("OPENAI_API_KEY"):
+        return OPENAI_MODEL
+    return ""
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    """Write text to path via a temp file and os.replace, so readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def _response_cache_path(
+    cache_dir: Path, prompt: str, max_tokens: int, instructions: str, schema: dict[str, Any] | None = None
+) -> Path:
+    """Cache file for one LLM request: sha256 of model | max_tokens | instructions + prompt (| schema, if any)."""
+    key = f"{_active_model()}|{max_tokens}|{instructions}{prompt}"
+    if schema is not None:
+        key += "|" + json.dumps(schema, sort_keys=True)
+    return cache_dir / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json"
+
+
+def _is_complete_response(response: str | None, schema: dict[str, Any] | None) -> bool:
+    """
+    True if response is worth caching: non-empty and, with a schema, JSON of the schema's root type
+    holding its required keys. Truncated responses never get here (they are recorded with _write_truncated_marker).
+    """
+    if not response:
+        return False
+    if schema is None:
+        return True
+    try:
+        data = json.loads(response)
+    except json.JSONDecodeError:
+        return False
+    if schema.get("type") == "object":
+        return isinstance(data, dict) and all(k in data for k in schema.get("required", []))
+    return isinstance(data, list)
+
+
+def _read_cached_response(path: Path, schema: dict[str, Any] | None = None) -> str | None:
+    """
+    Return the cached response text at path, or None on a miss (or an entry that is not a complete response).
+    Raise _OutputTruncated if the request is recorded as having hit max_tokens, so callers split it right away.
+    """
+    if not path.exists():
+        return None
+    entry = json.loads(path.read_text(encoding="utf-8"))
+    if entry.get("truncated"):
+        raise _OutputTruncated(f"Cached LLM response hit max_tokens ({path.name})")
+    response = entry.get("response")
+    return response if _is_complete_response(response, schema) else None
+
+
+def _write_cached_response(path: Path, response: str | None, schema: dict[str, Any] | None = None) -> None:
+    """Store a response; empty, unparseable or incomplete responses are not cached."""
+    if _is_complete_response(response, schema):
+        _atomic_write_text(path, json.dumps({"response": response}))
+
+
+def _write_truncated_marker(path: Path) -> None:
+    """Record that the request at path hit max_tokens, so reruns split it instead of re-sending it."""
+    _atomic_write_text(path, json.dumps({"truncated": True}))
+
+
+def _disk_cache(cache_dir: str | Path) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Decorator for _call_llm / _call_llm_async: return the cached response text for an identical
+    (model, max_tokens, instructions + prompt, schema), else call through and store the response.
+    Only complete responses are cached (see _is_complete_response), so a bad one is re-requested next run.
+    A request that raised _OutputTruncated is recorded as such and raises again on a cache hit.
+    The key is built from the call's arguments bound to fn's signature (defaults applied), so fn must take
+    prompt, max_tokens, instructions and schema parameters.
+    """
+    cache_dir = Path(cache_dir)
+    read, write = _read_cached_response, _write_cached_response
+
+    def decorator(fn: Callable[..., Any]) -> Callable[..., Any]:
+        signature = inspect.signature(fn)
+
+        def cache_key(args: tuple[Any, ...], kwargs: dict[str, Any]) -> tuple[Path, dict[str, Any] | None]:
+            # Bind against fn's own signature so defaults and positional calls key the same as keyword calls
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            a = bound.arguments
+            path = _response_cache_path(cache_dir, a["prompt"], a["max_tokens"], a["instructions"], a["schema"])
+            return path, a["schema"]
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> str:
+                path, schema = cache_key(args, kwargs)
+                cached = read(path, schema)
+                if cached is not None:
+                    return cached
+                try:
+                    response = await fn(*args, **kwargs)
+                except _OutputTruncated:
+                    _write_truncated_marker(path)
+                    raise
+                write(path, response, schema)
+                return response
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> str:
+            path, schema = cache_key(args, kwargs)
+            cached = read(path, schema)
+            if cached is not None:
+                return cached
+            try:
+                response = fn(*args, **kwargs)
+            except _OutputTruncated:
+                _write_truncated_marker(path)
+                raise
+            write(path, response, schema)
+            return response
+
+        return wrapper
+
+    return decorator
 
-def _call_gemini(prompt: str, max_tokens: int = 16000) -> str:
-    """Call Gemini API (Google GenAI SDK) and return generated text."""
+
+def _gemini_sdk() -> tuple[Any, Any]:
+    """Return (google.genai, google.genai.types)."""
     try:
         from google import genai
         from google.genai import types
@@ -46,80 +275,525 @@ def _call_gemini(prompt: str, max_tokens: int = 16000) -> str:
         raise ImportError(
             "google-genai package required for Gemini. pip install google-genai"
         )
+    return genai, types
+
+
+def _gemini_client() -> Any:
+    """Return a genai.Client for the configured Gemini key."""
+    genai, _types = _gemini_sdk()
     api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         raise ValueError("GEMINI_API_KEY or GOOGLE_API_KEY not set in environment or .env")
-    client = genai.Client(api_key=api_key)
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt,
-        config=types.GenerateContentConfig(max_output_tokens=max_tokens),
-    )
-    return (response.text or "").strip()
+    return genai.Client(api_key=api_key)
 
 
-def _call_openai(prompt: str, max_tokens: int = 16000) -> str:
-    """Call OpenAI API and return assistant content."""
+def _openai_sdk() -> Any:
+    """Return the openai module."""
     try:
-        from openai import OpenAI
+        import openai
     except ImportError:
         raise ImportError("openai package required for PDF index structuring. pip install openai")
+    return openai
+
+
+def _openai_api_key() -> str:
+    """Return OPENAI_API_KEY or raise if unset."""
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OPENAI_API_KEY not set in environment or .env")
-    client = OpenAI(api_key=api_key)
+    return api_key
+
+
+def _gemini_request(
+    types: Any,
+    model: str,
+    prompt: str,
+    max_tokens: int,
+    instructions: str,
+    schema: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    """generate_content kwargs; with a schema, request JSON output constrained to it."""
+    config_kwargs: dict[str, Any] = {"max_output_tokens": max_tokens}
+    if schema is not None:
+        config_kwargs.update(response_mime_type="application/json", response_schema=schema)
+    config = types.GenerateContentConfig(**config_kwargs)
+    return {"model": model, "contents": instructions + prompt, "config": config}
+
+
+def _openai_strict_schema(schema: dict[str, Any]) -> dict[str, Any]:
+    """Copy of schema as OpenAI strict mode wants it: every object closed and all of its properties required."""
+    out = dict(schema)
+    if out.get("type") == "object":
+        props = {k: _openai_strict_schema(v) for k, v in out.get("properties", {}).items()}
+        out.update(properties=props, required=list(props), additionalProperties=False)
+    elif out.get("type") == "array" and "items" in out:
+        out["items"] = _openai_strict_schema(out["items"])
+    return out
+
+
+def _openai_response_format(schema: dict[str, Any] | None) -> dict[str, Any]:
+    """chat.completions kwargs for structured output ({} without a schema)."""
+    if schema is None:
+        return {}
+    return {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "response", "schema": _openai_strict_schema(schema), "strict": True},
+        }
+    }
+
+
+class _OutputTruncated(RuntimeError):
+    """The provider stopped at the output token limit, so the response text is incomplete."""
+
+
+def _gemini_truncated(response: Any) -> bool:
+    """True if Gemini stopped generating because it reached max_output_tokens."""
+    candidates = getattr(response, "candidates", None) or []
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", str(reason)) == "MAX_TOKENS"
+
+
+@contextlib.asynccontextmanager
+async def _gemini_async_client() -> AsyncIterator[Any]:
+    """genai.Client whose sync and aio sides are both closed on exit."""
+    client = _gemini_client()
+    try:
+        yield client
+    finally:
+        _close_gemini_sync(client)
+        aclose = getattr(client.aio, "aclose", None)  # older google-genai versions have no aclose()
+        if aclose is not None:
+            await aclose()
+
+
+def _close_gemini_sync(client: Any) -> None:
+    """Close the sync httpx side of a genai.Client (older google-genai versions have no close())."""
+    close = getattr(client, "close", None)
+    if close is not None:
+        close()
+
+
+@contextlib.asynccontextmanager
+async def _openai_async_client() -> AsyncIterator[Any]:
+    """AsyncOpenAI client with SDK retries off (retried by _with_retries_async), closed on exit."""
+    async with _openai_sdk().AsyncOpenAI(api_key=_openai_api_key(), max_retries=0) as client:
+        yield client
+
+
+@contextlib.asynccontextmanager
+async def _async_llm_client() -> AsyncIterator[Any]:
+    """
+    One async client for the configured provider, shared by all requests of a run so connections
+    are reused, and closed on exit. Yields None if no provider key is set (_call_llm_async then raises).
+    """
+    if os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"):
+        async with _gemini_async_client() as client:
+            yield client
+    elif os.environ.get("OPENAI_API_KEY"):
+        async with _openai_async_client() as client:
+            yield client
+    else:
+        yield None
+
+
+def _call_gemini(
+    prompt: str,
+    model: str = GEMINI_MODEL,
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schema: dict[str, Any] | None = None,
+    client: Any = None,
+) -> str:
+    """
+    Call Gemini API (Google GenAI SDK) and return generated text; raise _OutputTruncated at max_tokens.
+    Uses client (a genai.Client) if given, else a one-off client that is closed afterwards.
+    """
+    if client is None:
+        own_client = _gemini_client()
+        try:
+            return _call_gemini(prompt, model, max_tokens, instructions, schema, client=own_client)
+        finally:
+            # genai.Client opens a sync and an async httpx client; close both.
+            _close_gemini_sync(own_client)
+            aclose = getattr(own_client.aio, "aclose", None)
+            if aclose is not None:
+                asyncio.run(aclose())
+    _genai, types = _gemini_sdk()
+    response = client.models.generate_content(
+        **_gemini_request(types, model, prompt, max_tokens, instructions, schema)
+    )
+    if _gemini_truncated(response):
+        raise _OutputTruncated(f"Gemini output reached max_output_tokens={max_tokens}")
+    return (response.text or "").strip()
+
+
+async def _call_gemini_async(
+    prompt: str,
+    model: str = GEMINI_MODEL,
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schema: dict[str, Any] | None = None,
+    client: Any = None,
+) -> str:
+    """Non-blocking _call_gemini via the SDK's aio client (of client if given, else of a one-off client)."""
+    if client is None:
+        async with _gemini_async_client() as own_client:
+            return await _call_gemini_async(prompt, model, max_tokens, instructions, schema, client=own_client)
+    _genai, types = _gemini_sdk()
+    response = await client.aio.models.generate_content(
+        **_gemini_request(types, model, prompt, max_tokens, instructions, schema)
+    )
+    if _gemini_truncated(response):
+        raise _OutputTruncated(f"Gemini output reached max_output_tokens={max_tokens}")
+    return (response.text or "").strip()
+
+
+def _call_openai(
+    prompt: str,
+    model: str = OPENAI_MODEL,
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schema: dict[str, Any] | None = None,
+    client: Any = None,
+) -> str:
+    """
+    Call OpenAI API and return assistant content; raise _OutputTruncated at max_tokens.
+    Uses client (an OpenAI client) if given, else a one-off client that is closed afterwards.
+    """
+    if client is None:
+        # SDK retries off: retried by _with_retries
+        with _openai_sdk().OpenAI(api_key=_openai_api_key(), max_retries=0) as own_client:
+            return _call_openai(prompt, model, max_tokens, instructions, schema, client=own_client)
     response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
+        model=model,
+        messages=[{"role": "user", "content": instructions + prompt}],
         max_tokens=max_tokens,
+        **_openai_response_format(schema),
     )
-    return (response.choices[0].message.content or "").strip()
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        raise _OutputTruncated(f"OpenAI output reached max_tokens={max_tokens}")
+    return (choice.message.content or "").strip()
 
 
-def _call_llm(prompt: str, max_tokens: int = 16000) -> str:
-    """Call configured LLM (Gemini or OpenAI) and return response text."""
+async def _call_openai_async(
+    prompt: str,
+    model: str = OPENAI_MODEL,
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schema: dict[str, Any] | None = None,
+    client: Any = None,
+) -> str:
+    """Non-blocking _call_openai via AsyncOpenAI (client if given, else a one-off client)."""
+    if client is None:
+        async with _openai_async_client() as own_client:
+            return await _call_openai_async(prompt, model, max_tokens, instructions, schema, client=own_client)
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": instructions + prompt}],
+        max_tokens=max_tokens,
+        **_openai_response_format(schema),
+    )
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        raise _OutputTruncated(f"OpenAI output reached max_tokens={max_tokens}")
+    return (choice.message.content or "").strip()
+
+
+def _run_openai_batch_job(client: Any, lines: dict[str, str]) -> tuple[dict[str, str | None], dict[str, str]]:
+    """
+    Submit lines (custom_id -> request JSONL line) as one Batch API job and wait for it.
+    Return (responses, errors): content per succeeded custom_id (None if it stopped at max_tokens), and an
+    error message per custom_id that failed, was routed to the error file, or is missing from the output.
+    """
+    input_file = client.files.create(
+        file=("batch.jsonl", "\n".join(lines.values()).encode("utf-8")), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(OPENAI_BATCH_POLL_SECONDS)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise RuntimeError(f"OpenAI batch {batch.id} ended with status {batch.status}")
+
+    responses: dict[str, str | None] = {}
+    errors: dict[str, str] = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            custom_id = result.get("custom_id")
+            response = result.get("response") or {}
+            body = response.get("body") or {}
+            choices = body.get("choices") or []
+            if response.get("status_code") != 200 or result.get("error") or not choices:
+                error = result.get("error") or body.get("error") or {}
+                errors[custom_id] = f"status {response.get('status_code')}: {error.get('message') or error}"
+            elif choices[0].get("finish_reason") == "length":
+                responses[custom_id] = None
+            else:
+                responses[custom_id] = (choices[0]["message"]["content"] or "").strip()
+    for custom_id in lines:
+        if custom_id not in responses and custom_id not in errors:
+            errors[custom_id] = "missing from batch output"
+    counts = getattr(batch, "request_counts", None)
+    if counts is not None and getattr(counts, "failed", 0) and not errors:
+        raise RuntimeError(f"OpenAI batch {batch.id} reports {counts.failed} failed requests without error lines")
+    return responses, errors
+
+
+def _call_openai_batch(
+    prompts: list[str],
+    model: str = OPENAI_MODEL,
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schemas: list[dict[str, Any] | None] | None = None,
+) -> list[str | None]:
+    """
+    Run prompts as OpenAI Batch API jobs (/v1/chat/completions, 24h window) and return the responses
+    in prompt order (None for one that stopped at max_tokens). Blocks while polling.
+    Requests that fail are resubmitted in a new job, up to OPENAI_BATCH_MAX_ATTEMPTS jobs in all;
+    if any still fail, RuntimeError is raised. schemas, if given, holds one response schema (or None) per prompt.
+    """
+    schemas = schemas or [None] * len(prompts)
+    pending = {
+        f"req-{i}": json.dumps({
+            "custom_id": f"req-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [{"role": "user", "content": instructions + prompt}],
+                "max_tokens": max_tokens,
+                **_openai_response_format(schema),
+            },
+        })
+        for i, (prompt, schema) in enumerate(zip(prompts, schemas))
+    }
+    done: dict[str, str | None] = {}
+    errors: dict[str, str] = {}
+    with _openai_sdk().OpenAI(api_key=_openai_api_key()) as client:
+        for _attempt in range(OPENAI_BATCH_MAX_ATTEMPTS):
+            if not pending:
+                break
+            responses, errors = _run_openai_batch_job(client, pending)
+            done.update(responses)
+            pending = {custom_id: pending[custom_id] for custom_id in errors}
+    if pending:
+        custom_id, error = next(iter(errors.items()))
+        raise RuntimeError(
+            f"{len(pending)} OpenAI batch requests failed after {OPENAI_BATCH_MAX_ATTEMPTS} attempts "
+            f"(e.g. {custom_id}: {error})"
+        )
+    return [done[f"req-{i}"] for i in range(len(prompts))]
+
+
+def _use_openai_batch() -> bool:
+    """True when BOOK_INDEXED_BATCH=1 and OpenAI is the configured provider."""
+    return os.environ.get("BOOK_INDEXED_BATCH") == "1" and _active_model() == OPENAI_MODEL
+
+
+def _call_llm_batch(
+    prompts: list[str],
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schemas: list[dict[str, Any] | None] | None = None,
+) -> list[str | None]:
+    """
+    _call_openai_batch behind the response disk cache: only uncached prompts are submitted.
+    None marks a response that stopped at max_tokens, now or (per its cached marker) on an earlier run.
+    """
+    schemas = schemas or [None] * len(prompts)
+    paths = [
+        _response_cache_path(LLM_CACHE_DIR, p, max_tokens, instructions, schema)
+        for p, schema in zip(prompts, schemas)
+    ]
+    responses: list[str | None] = []
+    missing: list[int] = []
+    for i, (path, schema) in enumerate(zip(paths, schemas)):
+        try:
+            cached = _read_cached_response(path, schema)
+        except _OutputTruncated:
+            cached = None  # known to truncate: the caller splits it without resubmitting
+        else:
+            if cached is None:
+                missing.append(i)
+        responses.append(cached)
+    if missing:
+        fresh = _call_openai_batch(
+            [prompts[i] for i in missing],
+            model=OPENAI_MODEL,
+            max_tokens=max_tokens,
+            instructions=instructions,
+            schemas=[schemas[i] for i in missing],
+        )
+        for i, response in zip(missing, fresh):
+            if response is None:
+                _write_truncated_marker(paths[i])
+            else:
+                _write_cached_response(paths[i], response, schemas[i])
+            responses[i] = response
+    return responses
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """True for rate limits (429), server errors (5xx) and connection/timeout errors from either SDK."""
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in _RETRYABLE_ERROR_NAMES for cls in type(exc).__mro__)
+
+
+def _retry_delay(attempt: int) -> float:
+    """Backoff before retry number attempt (0-based): exponential, capped, with jitter."""
+    delay = min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2**attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _with_retries(fn: Callable[..., str], *args: Any, **kwargs: Any) -> str:
+    """Call fn, retrying retryable errors (see _is_retryable) up to LLM_MAX_RETRIES times."""
+    for attempt in range(LLM_MAX_RETRIES):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as exc:
+            if not _is_retryable(exc):
+                raise
+            time.sleep(_retry_delay(attempt))
+    return fn(*args, **kwargs)
+
+
+async def _with_retries_async(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> str:
+    """Async _with_retries: backs off with asyncio.sleep so other requests keep running."""
+    for attempt in range(LLM_MAX_RETRIES):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as exc:
+            if not _is_retryable(exc):
+                raise
+            await asyncio.sleep(_retry_delay(attempt))
+    return await fn(*args, **kwargs)
+
+
+def _max_concurrency() -> int:
+    """LLM_MAX_CONCURRENCY from the environment, else the module default."""
+    return max(1, int(os.environ.get("LLM_MAX_CONCURRENCY") or LLM_MAX_CONCURRENCY))
+
+
+@_disk_cache(LLM_CACHE_DIR)
+def _call_llm(
+    prompt: str,
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schema: dict[str, Any] | None = None,
+    client: Any = None,
+) -> str:
+    """
+    Call configured LLM (Gemini or OpenAI) and return response text.
+    instructions is a static prefix sent before prompt.
+    With a schema, the provider returns JSON conforming to it (structured output).
+    Transient failures are retried with backoff (see _with_retries).
+    client, if given, is a provider client to reuse; otherwise a one-off client is created and closed.
+    """
     if os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"):
-        return _call_gemini(prompt, max_tokens=max_tokens)
+        return _with_retries(
+            _call_gemini,
+            prompt,
+            model=GEMINI_MODEL,
+            max_tokens=max_tokens,
+            instructions=instructions,
+            schema=schema,
+            client=client,
+        )
     if os.environ.get("OPENAI_API_KEY"):
-        return _call_openai(prompt, max_tokens=max_tokens)
+        return _with_retries(
+            _call_openai,
+            prompt,
+            model=OPENAI_MODEL,
+            max_tokens=max_tokens,
+            instructions=instructions,
+            schema=schema,
+            client=client,
+        )
     raise ValueError(
         "Set GEMINI_API_KEY, GOOGLE_API_KEY, or OPENAI_API_KEY in .env for PDF index structuring."
     )
 
 
-def _extract_json_from_response(text: str) -> list[dict[str, Any]]:
-    """Extract JSON array from LLM response (handle markdown code blocks)."""
-    text = text.strip()
-    # Remove markdown code block if present
-    if "```" in text:
-        for part in text.split("```"):
-            part = part.strip()
-            if part.startswith("json"):
-                part = part[4:].strip()
-            if part.startswith("["):
-                try:
-                    return json.loads(part)
-                except json.JSONDecodeError:
-                    continue
+@_disk_cache(LLM_CACHE_DIR)
+async def _call_llm_async(
+    prompt: str,
+    max_tokens: int = 16000,
+    instructions: str = "",
+    schema: dict[str, Any] | None = None,
+    client: Any = None,
+) -> str:
+    """Async _call_llm: same provider selection and retries; client comes from _async_llm_client."""
+    if os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"):
+        return await _with_retries_async(
+            _call_gemini_async,
+            prompt,
+            model=GEMINI_MODEL,
+            max_tokens=max_tokens,
+            instructions=instructions,
+            schema=schema,
+            client=client,
+        )
+    if os.environ.get("OPENAI_API_KEY"):
+        return await _with_retries_async(
+            _call_openai_async,
+            prompt,
+            model=OPENAI_MODEL,
+            max_tokens=max_tokens,
+            instructions=instructions,
+            schema=schema,
+            client=client,
+        )
+    raise ValueError(
+        "Set GEMINI_API_KEY, GOOGLE_API_KEY, or OPENAI_API_KEY in .env for PDF index structuring."
+    )
+
+
+def _extract_json_from_response(text: str, as_object: bool = False) -> Any:
+    """
+    Extract JSON array from free-form LLM response (handle markdown code blocks).
+    With as_object=True, extract a JSON object instead ({} if none is found).
+    """
+    open_char, container = ("{", dict) if as_object else ("[", list)
+    text = _CODE_FENCE_RE.sub("", text.strip())
+    # Decode from each candidate opening bracket; raw_decode handles brackets inside strings
+    start = text.find(open_char)
+    while start != -1:
+        try:
+            data, _end = _JSON_DECODER.raw_decode(text, start)
+            if isinstance(data, container):
+                return data
+        except json.JSONDecodeError:
+            pass
+        start = text.find(open_char, start + 1)
+    return container()
+
+
+def _parse_json_response(text: str, as_object: bool = False) -> Any:
+    """
+    Parse a structured-output response (plain JSON); fall back to _extract_json_from_response
+    for free-form text, e.g. responses cached before structured output was requested.
+    """
+    container = dict if as_object else list
     try:
-        return json.loads(text)
+        data = json.loads(text)
     except json.JSONDecodeError:
-        pass
-    # Try to find [...] substring
-    start = text.find("[")
-    if start != -1:
-        depth = 0
-        for i in range(start, len(text)):
-            if text[i] == "[":
-                depth += 1
-            elif text[i] == "]":
-                depth -= 1
-                if depth == 0:
-                    try:
-                        return json.loads(text[start : i + 1])
-                    except json.JSONDecodeError:
-                        break
-    return []
+        return _extract_json_from_response(text, as_object=as_object)
+    return data if isinstance(data, container) else _extract_json_from_response(text, as_object=as_object)
 
 
 def _normalize_pages_to_refs(pages: Any) -> list[tuple[None, int, int]]:
@@ -150,13 +824,87 @@ def _normalize_pages_to_refs(pages: Any) -> list[tuple[None, int, int]]:
     return refs
 
 
-def structure_index_with_llm(index_raw: str) -> list[dict[str, Any]]:
+def _preclean_index(index_raw: str) -> str:
     """
-    Send raw index text to LLM and return list of {term, subentry, refs: [(None, start, end), ...]}.
+    Drop whitespace that costs prompt tokens but carries no information: runs of spaces/tabs become
+    one space, trailing spaces go, and blank-line runs collapse to one blank line.
+    Number-only lines are kept, since they can be page refs wrapped onto their own line.
+    """
+    text = _INLINE_SPACE_RE.sub(" ", index_raw)
+    text = _TRAILING_SPACE_RE.sub("", text)
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def _chunk_index_text(index_raw: str, max_chars: int) -> list[str]:
+    """Split index text into blocks of at most max_chars, breaking at line boundaries where possible."""
+    chunks: list[str] = []
+    current: list[str] = []
+    size = 0
+    for line in index_raw.splitlines(keepends=True):
+        while len(line) > max_chars:
+            # A single over-long line: hard-split it
+            if current:
+                chunks.append("".join(current))
+                current, size = [], 0
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        if size + len(line) > max_chars and current:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current:
+        chunks.append("".join(current))
+    return [c for c in chunks if c.strip()]
+
+
+def _index_request_chars(max_tokens: int) -> int:
+    """Index text per request whose structured output fits comfortably in max_tokens."""
+    return int(max_tokens * INDEX_OUTPUT_HEADROOM / INDEX_OUTPUT_TOKENS_PER_CHAR)
+
+
+def _index_context(preceding: str) -> str:
+    """Last INDEX_CONTEXT_LINES non-blank lines of preceding, for subentries at the top of the next block."""
+    lines = [line for line in preceding.splitlines() if line.strip()]
+    return "\n".join(lines[-INDEX_CONTEXT_LINES:])
+
+
+def _index_prompt(block: str, context: str = "") -> str:
+    """
+    One index block, sent after INDEX_STRUCTURE_PROMPT.
+    context (the lines before the block, from the previous request) is prepended as [Context].
+    """
+    head = f"[Context]\n{context}\n\n" if context else ""
+    return f"{head}{block.strip()}\n"
+
+
+def _split_index_block(block: str, context: str) -> list[tuple[str, str]] | None:
+    """
+    Halve a block whose output hit the token limit, between lines; the second half carries the
+    first half's trailing lines as context. None if the block is a single line.
     """
-    prompt = INDEX_STRUCTURE_PROMPT.format(index_raw=index_raw[:50000])
-    response = _call_llm(prompt)
-    data = _extract_json_from_response(response)
+    lines = block.splitlines(keepends=True)
+    if len(lines) < 2:
+        return None
+    mid = len(lines) // 2
+    first, second = "".join(lines[:mid]), "".join(lines[mid:])
+    return [(first, context), (second, _index_context(first))]
+
+
+def _items_from_index_response(response: str) -> list[Any]:
+    """Index items of a response: its "entries" list, or a bare JSON list if the model ignored the object."""
+    data = _parse_json_response(response, as_object=True)
+    entries = data.get("entries")
+    if isinstance(entries, list):
+        return entries
+    items = _parse_json_response(response)
+    if not items and not data and "[]" not in "".join(response.split()):
+        raise RuntimeError(f"LLM response for an index block is not valid JSON: {response[:200]!r}")
+    return items
+
+
+def _index_entries_from_items(data: list[Any]) -> list[dict[str, Any]]:
+    """Convert parsed LLM index items to {term, subentry, refs: [(None, start, end), ...]}."""
     out = []
     for item in data:
         if not isinstance(item, dict):
@@ -170,15 +918,96 @@ def structure_index_with_llm(index_raw: str) -> list[dict[str, Any]]:
     return out
 
 
+async def structure_index_with_llm_async(
+    index_raw: str, max_concurrency: int | None = None
+) -> list[dict[str, Any]]:
+    """
+    Send raw index text to LLM and return list of {term, subentry, refs: [(None, start, end), ...]}.
+    The text is chunked into one block per request, sized so the structured output fits the model's output
+    limit; a request that still hits the limit is split in half and re-requested. Each request after the first
+    carries the preceding lines as [Context]. Requests run concurrently, at most max_concurrency in flight
+    (default: LLM_MAX_CONCURRENCY env or 4).
+    With BOOK_INDEXED_BATCH=1 and OpenAI configured, all requests go through Batch API jobs instead.
+    """
+    max_tokens = MAX_OUTPUT_TOKENS.get(_active_model(), 16000)
+    chunks = _chunk_index_text(_preclean_index(index_raw), _index_request_chars(max_tokens))
+    blocks = [(chunk, _index_context(chunks[i - 1]) if i else "") for i, chunk in enumerate(chunks)]
+
+    def split(block: str, context: str) -> list[tuple[str, str]]:
+        halves = _split_index_block(block, context)
+        if halves is None:
+            raise _OutputTruncated(f"LLM output for one index line exceeded max_tokens={max_tokens}")
+        return halves
+
+    if _use_openai_batch():
+        # Rounds of Batch API jobs; blocks whose output hit the limit are split for the next round
+        pending: list[tuple[str, str] | list[Any]] = list(blocks)
+        while any(isinstance(p, tuple) for p in pending):
+            todo = [p for p in pending if isinstance(p, tuple)]
+            responses = await asyncio.to_thread(
+                _call_llm_batch,
+                [_index_prompt(*p) for p in todo],
+                max_tokens=max_tokens,
+                instructions=INDEX_STRUCTURE_PROMPT,
+                schemas=[INDEX_SCHEMA] * len(todo),
+            )
+            results = iter(responses)
+            next_pending: list[tuple[str, str] | list[Any]] = []
+            for p in pending:
+                if not isinstance(p, tuple):
+                    next_pending.append(p)
+                    continue
+                response = next(results)
+                if response is None:
+                    next_pending.extend(split(*p))
+                else:
+                    next_pending.append(_items_from_index_response(response))
+            pending = next_pending
+        data = [item for items in pending for item in items]
+        return _index_entries_from_items(data)
+
+    semaphore = asyncio.Semaphore(max_concurrency or _max_concurrency())
+
+    # One client (and connection pool) for every request of this run
+    async with _async_llm_client() as client:
+
+        async def run(block: str, context: str) -> list[Any]:
+            try:
+                async with semaphore:
+                    response = await _call_llm_async(
+                        _index_prompt(block, context),
+                        max_tokens=max_tokens,
+                        instructions=INDEX_STRUCTURE_PROMPT,
+                        schema=INDEX_SCHEMA,
+                        client=client,
+                    )
+            except _OutputTruncated:
+                parts = await asyncio.gather(*(run(*half) for half in split(block, context)))
+                return [item for items in parts for item in items]
+            return _items_from_index_response(response)
+
+        # gather keeps request order, so entries stay in index order
+        parts = await asyncio.gather(*(run(block, context) for block, context in blocks))
+    return _index_entries_from_items([item for items in parts for item in items])
+
+
+def structure_index_with_llm(index_raw: str) -> list[dict[str, Any]]:
+    """Sync wrapper around structure_index_with_llm_async (not for use inside a running event loop)."""
+    return asyncio.run(structure_index_with_llm_async(index_raw))
+
+
 def structure_toc_with_llm(toc_raw: str, last_page: int = 500) -> list[dict[str, Any]]:
     """
     Send raw TOC text to LLM and return list of {name, start_page, end_page}.
     """
     if not toc_raw.strip():
         return []
-    prompt = TOC_STRUCTURE_PROMPT.format(toc_raw=toc_raw[:8000])
-    response = _call_llm(prompt, max_tokens=4000)
-    data = _extract_json_from_response(response)
+    response = _call_llm(
+        toc_raw[:8000] + "\n", max_tokens=4000, instructions=TOC_STRUCTURE_PROMPT, schema=TOC_SCHEMA
+    )
+    data = _parse_json_response(response, as_object=True).get("chapters")
+    if not isinstance(data, list):
+        data = _parse_json_response(response)
     out = []
     for i, item in enumerate(data):
         if not isinstance(item, dict):